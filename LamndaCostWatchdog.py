@@ -1,314 +1,624 @@
-import boto3  # type: ignore
-import datetime
-import logging
-import os
-import json
-from collections import defaultdict
-
-# Setup logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# Environment variables
-SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:15159149893:aws-daily-cleanup-report')
-SNAPSHOT_RETENTION_DAYS = int(os.getenv('SNAPSHOT_RETENTION_DAYS', '30'))
-LOW_CPU_THRESHOLD = float(os.getenv('LOW_CPU_THRESHOLD', '5.0'))
-CLEANUP_UNTAGGED_AFTER_DAYS = int(os.getenv('CLEANUP_UNTAGGED_AFTER_DAYS', '7'))
-
-def publish_sns(message, subject="AWS Daily Cleanup Report"):
-    """Send summary to SNS if topic ARN is configured"""
-    if SNS_TOPIC_ARN:
-        sns = boto3.client('sns')
-        sns.publish(TopicArn=SNS_TOPIC_ARN, Message=message, Subject=subject)
-    else:
-        logger.info("No SNS topic configured; skipping notification.")
-
-def get_resource_age(creation_date):
-    """Calculate resource age in days"""
-    if isinstance(creation_date, str):
-        creation_date = datetime.datetime.fromisoformat(creation_date.replace('Z', '+00:00'))
-    return (datetime.datetime.now(datetime.timezone.utc) - creation_date).days
-
-def lambda_handler(event, context):
-    logger.info("Starting enhanced AWS cost optimization job...")
-
-    ec2 = boto3.client('ec2')
-    s3 = boto3.client('s3')
-    rds = boto3.client('rds')
-    cloudwatch = boto3.client('cloudwatch')
-    lambda_client = boto3.client('lambda')
-    elbv2 = boto3.client('elbv2')
-    logs = boto3.client('logs')
-    ce = boto3.client('ce')
-
-    summary = []
-    cost_savings = 0
-
-    # --- 1. Terminate stopped EC2 instances ---
-    instances = ec2.describe_instances()
-    stopped = []
-    for reservation in instances['Reservations']:
-        for instance in reservation['Instances']:
-            state = instance['State']['Name']
-            instance_id = instance['InstanceId']
-            if state == 'stopped':
-                stopped.append(instance_id)
-
-    if stopped:
-        ec2.terminate_instances(InstanceIds=stopped)
-        summary.append(f"Terminated stopped EC2 instances: {stopped}")
-    else:
-        summary.append("No stopped EC2 instances found.")
-
-    # --- 2. Delete unattached EBS volumes ---
-    volumes = ec2.describe_volumes(Filters=[{'Name': 'status', 'Values': ['available']}])
-    unused_volumes = [v['VolumeId'] for v in volumes['Volumes']]
-    if unused_volumes:
-        for vid in unused_volumes:
-            ec2.delete_volume(VolumeId=vid)
-        summary.append(f"Deleted unused EBS volumes: {unused_volumes}")
-    else:
-        summary.append("No unattached EBS volumes found.")
-
-    # --- 3. Release unused Elastic IPs ---
-    addresses = ec2.describe_addresses()['Addresses']
-    unattached_eips = [a['AllocationId'] for a in addresses if 'InstanceId' not in a]
-    if unattached_eips:
-        for alloc in unattached_eips:
-            ec2.release_address(AllocationId=alloc)
-        summary.append(f"Released unused Elastic IPs: {unattached_eips}")
-    else:
-        summary.append("No unattached Elastic IPs found.")
-
-    # --- 4. Delete empty S3 buckets ---
-    buckets = s3.list_buckets().get('Buckets', [])
-    for bucket in buckets:
-        name = bucket['Name']
-        try:
-            objs = s3.list_objects_v2(Bucket=name)
-            if objs.get('KeyCount', 0) == 0:
-                s3.delete_bucket(Bucket=name)
-                summary.append(f"Deleted empty S3 bucket: {name}")
-        except Exception as e:
-            logger.warning(f"Could not check/delete bucket {name}: {e}")
-
-    # --- 5. Check EC2 usage (Free Tier 750 hours per month) ---
-    now = datetime.datetime.now(datetime.timezone.utc)
-    start = now - datetime.timedelta(days=30)
-    metrics = cloudwatch.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName='CPUUtilization',
-        StartTime=start,
-        EndTime=now,
-        Period=86400,
-        Statistics=['Average']
-    )
-
-    # Count running hours for EC2 micro instances
-    running_instances = ec2.describe_instances(
-        Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
-    )
-    instance_hours = len(running_instances['Reservations']) * 24 * 30
-    if instance_hours > 750:
-        summary.append(f"⚠️ EC2 usage likely exceeds Free Tier (estimated {instance_hours} hours).")
-    else:
-        summary.append(f"EC2 usage within free-tier limits ({instance_hours} hours est.).")
-
-    # --- 6. Check S3 usage (Free Tier 5 GB) ---
-    total_storage_gb = 0
-    for bucket in buckets:
-        name = bucket['Name']
-        try:
-            metrics = cloudwatch.get_metric_statistics(
-                Namespace='AWS/S3',
-                MetricName='BucketSizeBytes',
-                Dimensions=[
-                    {'Name': 'BucketName', 'Value': name},
-                    {'Name': 'StorageType', 'Value': 'StandardStorage'}
-                ],
-                StartTime=start,
-                EndTime=now,
-                Period=86400,
-                Statistics=['Average']
-            )
-            if metrics['Datapoints']:
-                bytes_used = metrics['Datapoints'][-1]['Average']
-                total_storage_gb += bytes_used / (1024 ** 3)
-        except Exception as e:
-            logger.warning(f"Could not get S3 metrics for {name}: {e}")
-
-    if total_storage_gb > 5:
-        summary.append(f"⚠️ S3 storage exceeds free tier: {total_storage_gb:.2f} GB")
-    else:
-        summary.append(f"S3 storage within free tier: {total_storage_gb:.2f} GB")
-
-    # --- 7. Check Lambda usage (Free Tier: 1M requests) ---
-    metrics = cloudwatch.get_metric_statistics(
-        Namespace='AWS/Lambda',
-        MetricName='Invocations',
-        StartTime=start,
-        EndTime=now,
-        Period=86400,
-        Statistics=['Sum']
-    )
-    total_invocations = sum(dp['Sum'] for dp in metrics.get('Datapoints', []))
-    if total_invocations > 1_000_000:
-        summary.append(f"⚠️ Lambda usage exceeded free tier: {int(total_invocations)} invocations.")
-    else:
-        summary.append(f"Lambda usage within free tier: {int(total_invocations)} invocations.")
-
-    # --- 8. Check RDS free-tier usage (750 hours/month) ---
-    rds_instances = rds.describe_db_instances()['DBInstances']
-    active_rds = [r['DBInstanceIdentifier'] for r in rds_instances if r['DBInstanceStatus'] == 'available']
-    rds_hours = len(active_rds) * 24 * 30
-    if rds_hours > 750:
-        summary.append(f"⚠️ RDS usage likely exceeds Free Tier ({rds_hours} hours est.).")
-    else:
-        summary.append(f"RDS usage within free tier ({rds_hours} hours est.).")
-
-    # --- 9. Delete old EBS snapshots ---
-    snapshots = ec2.describe_snapshots(OwnerIds=['self'])['Snapshots']
-    old_snapshots = []
-    for snap in snapshots:
-        age = get_resource_age(snap['StartTime'])
-        if age > SNAPSHOT_RETENTION_DAYS:
-            old_snapshots.append(snap['SnapshotId'])
-            try:
-                ec2.delete_snapshot(SnapshotId=snap['SnapshotId'])
-            except Exception as e:
-                logger.warning(f"Could not delete snapshot {snap['SnapshotId']}: {e}")
-    
-    if old_snapshots:
-        summary.append(f"Deleted {len(old_snapshots)} old snapshots (>{SNAPSHOT_RETENTION_DAYS} days)")
-        cost_savings += len(old_snapshots) * 0.05  # ~$0.05 per GB-month
-
-    # --- 10. Remove unused security groups ---
-    security_groups = ec2.describe_security_groups()['SecurityGroups']
-    instances = ec2.describe_instances()
-    used_sgs = set()
-    for reservation in instances['Reservations']:
-        for instance in reservation['Instances']:
-            if instance['State']['Name'] != 'terminated':
-                for sg in instance['SecurityGroups']:
-                    used_sgs.add(sg['GroupId'])
-    
-    unused_sgs = []
-    for sg in security_groups:
-        if sg['GroupName'] != 'default' and sg['GroupId'] not in used_sgs:
-            try:
-                ec2.delete_security_group(GroupId=sg['GroupId'])
-                unused_sgs.append(sg['GroupId'])
-            except Exception as e:
-                logger.warning(f"Could not delete security group {sg['GroupId']}: {e}")
-    
-    if unused_sgs:
-        summary.append(f"Deleted {len(unused_sgs)} unused security groups")
-
-    # --- 11. Delete unused load balancers ---
-    load_balancers = elbv2.describe_load_balancers()['LoadBalancers']
-    unused_lbs = []
-    for lb in load_balancers:
-        targets = elbv2.describe_target_groups(LoadBalancerArn=lb['LoadBalancerArn'])
-        if not targets['TargetGroups']:
-            try:
-                elbv2.delete_load_balancer(LoadBalancerArn=lb['LoadBalancerArn'])
-                unused_lbs.append(lb['LoadBalancerName'])
-                cost_savings += 18.25  # ~$18.25/month per ALB
-            except Exception as e:
-                logger.warning(f"Could not delete load balancer {lb['LoadBalancerName']}: {e}")
-    
-    if unused_lbs:
-        summary.append(f"Deleted {len(unused_lbs)} unused load balancers")
-
-    # --- 12. Set CloudWatch log retention ---
-    log_groups = logs.describe_log_groups()['logGroups']
-    updated_logs = 0
-    for lg in log_groups:
-        if 'retentionInDays' not in lg or lg.get('retentionInDays', 0) > 30:
-            try:
-                logs.put_retention_policy(logGroupName=lg['logGroupName'], retentionInDays=30)
-                updated_logs += 1
-            except Exception as e:
-                logger.warning(f"Could not set retention for {lg['logGroupName']}: {e}")
-    
-    if updated_logs > 0:
-        summary.append(f"Set 30-day retention on {updated_logs} log groups")
-
-    # --- 13. Identify low-utilization instances ---
-    now = datetime.datetime.now(datetime.timezone.utc)
-    start = now - datetime.timedelta(days=7)
-    low_cpu_instances = []
-    
-    running_instances = ec2.describe_instances(
-        Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
-    )
-    
-    for reservation in running_instances['Reservations']:
-        for instance in reservation['Instances']:
-            instance_id = instance['InstanceId']
-            try:
-                metrics = cloudwatch.get_metric_statistics(
-                    Namespace='AWS/EC2',
-                    MetricName='CPUUtilization',
-                    Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-                    StartTime=start,
-                    EndTime=now,
-                    Period=86400,
-                    Statistics=['Average']
-                )
-                if metrics['Datapoints']:
-                    avg_cpu = sum(dp['Average'] for dp in metrics['Datapoints']) / len(metrics['Datapoints'])
-                    if avg_cpu < LOW_CPU_THRESHOLD:
-                        low_cpu_instances.append(f"{instance_id} ({avg_cpu:.1f}% CPU)")
-            except Exception as e:
-                logger.warning(f"Could not get CPU metrics for {instance_id}: {e}")
-    
-    if low_cpu_instances:
-        summary.append(f"⚠️ Low utilization instances (consider downsizing): {low_cpu_instances}")
-
-    # --- 14. Delete untagged resources older than threshold ---
-    untagged_volumes = []
-    volumes = ec2.describe_volumes()['Volumes']
-    for vol in volumes:
-        if not vol.get('Tags') and get_resource_age(vol['CreateTime']) > CLEANUP_UNTAGGED_AFTER_DAYS:
-            if vol['State'] == 'available':
-                untagged_volumes.append(vol['VolumeId'])
-    
-    if untagged_volumes:
-        summary.append(f"⚠️ Found {len(untagged_volumes)} untagged volumes older than {CLEANUP_UNTAGGED_AFTER_DAYS} days")
-
-    # --- 15. Cost analysis ---
-    try:
-        cost_response = ce.get_cost_and_usage(
-            TimePeriod={
-                'Start': (now - datetime.timedelta(days=30)).strftime('%Y-%m-%d'),
-                'End': now.strftime('%Y-%m-%d')
-            },
-            Granularity='MONTHLY',
-            Metrics=['BlendedCost'],
-            GroupBy=[{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
-        )
-        
-        monthly_costs = {}
-        for result in cost_response['ResultsByTime']:
-            for group in result['Groups']:
-                service = group['Keys'][0]
-                cost = float(group['Metrics']['BlendedCost']['Amount'])
-                monthly_costs[service] = cost
-        
-        top_costs = sorted(monthly_costs.items(), key=lambda x: x[1], reverse=True)[:5]
-        summary.append(f"Top 5 cost drivers: {dict(top_costs)}")
-        
-        total_monthly = sum(monthly_costs.values())
-        summary.append(f"Total monthly cost: ${total_monthly:.2f}")
-        
-    except Exception as e:
-        logger.warning(f"Could not retrieve cost data: {e}")
-
-    # --- Summary ---
-    summary.append(f"\n💰 Estimated monthly savings: ${cost_savings:.2f}")
-    report = "\n".join(summary)
-    logger.info("\n" + report)
-
-    publish_sns(report, "AWS Cost Optimization Report")
-    return {"status": "completed", "summary": summary, "estimated_savings": cost_savings}
+import boto3  # type: ignore
+from botocore.config import Config  # type: ignore
+from botocore.exceptions import ClientError  # type: ignore
+import datetime
+import heapq
+import io
+import logging
+import os
+import json
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Setup logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Environment variables
+SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:15159149893:aws-daily-cleanup-report')
+SNAPSHOT_RETENTION_DAYS = int(os.getenv('SNAPSHOT_RETENTION_DAYS', '30'))
+LOW_CPU_THRESHOLD = float(os.getenv('LOW_CPU_THRESHOLD', '5.0'))
+CLEANUP_UNTAGGED_AFTER_DAYS = int(os.getenv('CLEANUP_UNTAGGED_AFTER_DAYS', '7'))
+# Bucket that holds reports too large for SNS; they are sent as a presigned link instead
+REPORT_BUCKET = os.getenv('REPORT_BUCKET', '')
+# Threads used to run sections, and again to fan out per-resource calls, so a run uses
+# at most twice this many; lower it on small memory sizes
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '16'))
+if MAX_WORKERS < 1:
+    raise ValueError(f"MAX_WORKERS must be at least 1, got {MAX_WORKERS}")
+
+# Shared client configuration: sections run concurrently, so widen the connection
+# pool to cover every thread that may share a client (up to 2 * MAX_WORKERS), let
+# adaptive retries rate-limit against API throttling, and fail fast on stuck
+# connections so a retry can run instead of eating the Lambda timeout
+CFG = Config(
+    max_pool_connections=max(32, 2 * MAX_WORKERS),
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    connect_timeout=3,
+    read_timeout=15,
+    tcp_keepalive=True
+)
+# S3 work fans out per bucket, so give it a larger pool of its own
+S3_CFG = CFG.merge(Config(max_pool_connections=max(64, 2 * MAX_WORKERS)))
+SNS_MAX_MESSAGE_BYTES = 250_000  # SNS rejects messages over 256 KB
+METRIC_DATA_BATCH_SIZE = 500  # GetMetricData accepts at most 500 queries per request
+SEARCH_MAX_RESULTS = 500  # a SEARCH expression matches at most 500 metrics
+
+def log_retries(http_response, parsed, model, **kwargs):
+    """Log API calls that needed retries, e.g. because of throttling"""
+    attempts = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if attempts:
+        # after-call also fires for error responses, just before botocore raises them
+        outcome = "succeeded" if http_response.status_code < 300 else "failed"
+        logger.warning(f"{model.service_model.service_name} {model.name} {outcome} after {attempts} retries")
+
+def make_client(service, config=CFG, **kwargs):
+    """Create a boto3 client that reports retried calls"""
+    client = boto3.client(service, config=config, **kwargs)
+    client.meta.events.register('after-call', log_retries)
+    return client
+
+# Clients live at module scope so warm invocations reuse them and their open connections
+EC2 = make_client('ec2')
+S3 = make_client('s3', S3_CFG)
+RDS = make_client('rds')
+CLOUDWATCH = make_client('cloudwatch')
+ELBV2 = make_client('elbv2')
+LOGS = make_client('logs')
+CE = make_client('ce')
+SNS = make_client('sns')
+# One pool for every per-item call (deletes, bucket probes), shared by all sections so the
+# fan-out never adds more than MAX_WORKERS threads; its tasks never submit to it themselves
+ITEM_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+def upload_report(message):
+    """Upload the report to REPORT_BUCKET and return a message linking to it"""
+    # Sign with a client in the bucket's own region, or the SigV4 link will not work
+    s3 = s3_for(bucket_region(S3, {'Name': REPORT_BUCKET}))
+    key = f"reports/{uuid.uuid4()}.txt"
+    s3.put_object(Bucket=REPORT_BUCKET, Key=key, Body=message.encode('utf-8'))
+    url = s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': REPORT_BUCKET, 'Key': key},
+        ExpiresIn=86400
+    )
+    # The link may expire sooner than this, as it cannot outlive the role's session credentials
+    return f"Report too large for SNS; download it here: {url}"
+
+def truncate_report(message):
+    """Cut the report to the SNS size limit without splitting a UTF-8 character"""
+    note = "\n\n[Report truncated; see CloudWatch Logs for the full text]"
+    limit = SNS_MAX_MESSAGE_BYTES - len(note.encode('utf-8'))
+    return message.encode('utf-8')[:limit].decode('utf-8', 'ignore') + note
+
+def oversized_report_message(message):
+    """Replace a report too large for SNS with a link to it in S3, or truncate it"""
+    if REPORT_BUCKET:
+        try:
+            return upload_report(message)
+        except Exception as e:
+            logger.warning(f"Could not upload report to {REPORT_BUCKET}: {e}; truncating instead.")
+    else:
+        logger.warning("Report exceeds the SNS size limit and REPORT_BUCKET is not set; truncating.")
+    return truncate_report(message)
+
+def publish_sns(message, subject="AWS Daily Cleanup Report"):
+    """Send summary to SNS if topic ARN is configured"""
+    if SNS_TOPIC_ARN:
+        if len(message.encode('utf-8')) > SNS_MAX_MESSAGE_BYTES:
+            message = oversized_report_message(message)
+        SNS.publish(TopicArn=SNS_TOPIC_ARN, Message=message, Subject=subject)
+    else:
+        logger.info("No SNS topic configured; skipping notification.")
+
+def get_metric_datapoints(cloudwatch, queries, start, end, messages=None):
+    """Fetch (timestamp, value) pairs, newest first, for many metric queries, batching GetMetricData requests
+
+    If messages is a list, any Messages CloudWatch returns (such as a SEARCH hitting its result limit)
+    are appended to it.
+    """
+    datapoints = defaultdict(list)
+    paginator = cloudwatch.get_paginator('get_metric_data')
+    for i in range(0, len(queries), METRIC_DATA_BATCH_SIZE):
+        pages = paginator.paginate(
+            MetricDataQueries=queries[i:i + METRIC_DATA_BATCH_SIZE],
+            StartTime=start,
+            EndTime=end,
+            ScanBy='TimestampDescending'
+        )
+        for page in pages:
+            if messages is not None:
+                messages.extend(page.get('Messages', []))
+            for result in page['MetricDataResults']:
+                datapoints[result['Id']].extend(zip(result['Timestamps'], result['Values']))
+                if messages is not None:
+                    messages.extend(result.get('Messages', []))
+    return datapoints
+
+def fetch_usage_metrics(cloudwatch, instances, now):
+    """Fetch the metrics for sections 7 and 13 in one batch of GetMetricData requests
+
+    instances is the future of the shared instance listing. If that listing failed only the
+    Lambda query is sent; section 13 reports the listing error itself.
+    """
+    start = now - datetime.timedelta(days=30)
+    queries = [
+        {
+            'Id': 'lambda_invocations',
+            'MetricStat': {
+                'Metric': {'Namespace': 'AWS/Lambda', 'MetricName': 'Invocations'},
+                'Period': 86400,
+                'Stat': 'Sum'
+            },
+            'ReturnData': True
+        }
+    ]
+    try:
+        running_ids = [i['InstanceId'] for i in instances.result() if i['State']['Name'] == 'running']
+    except Exception:
+        running_ids = []
+    queries += [
+        {
+            'Id': f'cpu_{i}',
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'AWS/EC2',
+                    'MetricName': 'CPUUtilization',
+                    'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]
+                },
+                'Period': 86400,
+                'Stat': 'Average'
+            },
+            'ReturnData': True
+        }
+        for i, instance_id in enumerate(running_ids)
+    ]
+    datapoints = get_metric_datapoints(cloudwatch, queries, start, now)
+    return {
+        'lambda_invocations': datapoints['lambda_invocations'],
+        'instance_cpu': {
+            instance_id: datapoints[f'cpu_{i}'] for i, instance_id in enumerate(running_ids)
+        },
+    }
+
+def iter_all(client, operation, expression, **kwargs):
+    """Lazily yield the items of every page of a paginated list/describe call"""
+    return client.get_paginator(operation).paginate(**kwargs).search(expression)
+
+def list_all(client, operation, expression, **kwargs):
+    """Collect the items of every page of a paginated list/describe call"""
+    return list(iter_all(client, operation, expression, **kwargs))
+
+def describe_all_instances(ec2):
+    """List every EC2 instance once so sections can filter locally"""
+    return list_all(ec2, 'describe_instances', 'Reservations[].Instances[]')
+
+def run_each(action, items, description):
+    """Apply a single-item API call to every item concurrently; return the items that succeeded
+
+    Items may come from a generator: each call is submitted as soon as its item is produced.
+    If the generator raises, the calls already submitted are waited on and the error names them.
+    """
+    def attempt(item):
+        try:
+            action(item)
+            return True
+        except Exception as e:
+            logger.warning(f"Could not {description} {item}: {e}")
+            return False
+
+    futures = []
+    try:
+        for item in items:
+            futures.append((item, ITEM_EXECUTOR.submit(attempt, item)))
+    except Exception as e:
+        # Calls already sent still go through, so the report must not lose them with the error
+        done = [item for item, future in futures if future.result()]
+        raise RuntimeError(f"{e} (before that, managed to {description}: {done})") from e
+    return [item for item, future in futures if future.result()]
+
+# boto3 client creation is not thread-safe, so regional clients are built under a lock
+_s3_client_lock = threading.Lock()
+
+@lru_cache(maxsize=32)
+def s3_for(region):
+    """Return a cached S3 client for the given region, avoiding 301 redirects"""
+    with _s3_client_lock:
+        return make_client('s3', S3_CFG, region_name=region)
+
+def bucket_region(s3, bucket):
+    """Return a bucket's home region from ListBuckets, or from a HeadBucket probe"""
+    if bucket.get('BucketRegion'):
+        return bucket['BucketRegion']
+    try:
+        headers = s3.head_bucket(Bucket=bucket['Name'])['ResponseMetadata']['HTTPHeaders']
+    except ClientError as e:
+        # S3 reports the region even when it refuses the request
+        headers = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    return headers.get('x-amz-bucket-region', s3.meta.region_name)
+
+def probe_bucket(s3, bucket):
+    """Return (name, region, is_empty) for a bucket, or None if it cannot be read"""
+    name = bucket['Name']
+    try:
+        region = bucket_region(s3, bucket)
+        # A single key is enough to tell the bucket is not empty. This one LIST costs the
+        # same however many objects the bucket holds; reading an S3 Inventory manifest
+        # instead would take more calls (config, destination listing, manifest GET) and
+        # could be up to a day stale
+        resp = s3_for(region).list_objects_v2(Bucket=name, MaxKeys=1)
+        return name, region, not resp.get('Contents')
+    except Exception as e:
+        logger.warning(f"Could not check bucket {name}: {e}")
+        return None
+
+# Each section returns (summary_lines, estimated_monthly_savings)
+
+def section_stopped_ec2(ec2, instances):
+    """1. Terminate stopped EC2 instances"""
+    stopped = [i['InstanceId'] for i in instances.result() if i['State']['Name'] == 'stopped']
+
+    if stopped:
+        ec2.terminate_instances(InstanceIds=stopped)
+        return [f"Terminated stopped EC2 instances: {stopped}"], 0
+    return ["No stopped EC2 instances found."], 0
+
+def delete_unattached_volumes(ec2, volumes):
+    """Delete the unattached volumes; return (unattached ids, ids actually deleted)"""
+    unused_volumes = [v['VolumeId'] for v in volumes.result() if v['State'] == 'available']
+    return unused_volumes, run_each(lambda vid: ec2.delete_volume(VolumeId=vid), unused_volumes, "delete volume")
+
+def section_unattached_volumes(volume_deletes):
+    """2. Delete unattached EBS volumes"""
+    unused_volumes, deleted = volume_deletes.result()
+    if unused_volumes:
+        lines = [f"Deleted unused EBS volumes: {deleted}"]
+        failed = [vid for vid in unused_volumes if vid not in deleted]
+        if failed:
+            lines.append(f"⚠️ Could not delete unused EBS volumes: {failed}")
+        return lines, 0
+    return ["No unattached EBS volumes found."], 0
+
+def section_unused_eips(ec2):
+    """3. Release unused Elastic IPs"""
+    addresses = ec2.describe_addresses()['Addresses']
+    unattached_eips = [a['AllocationId'] for a in addresses if 'InstanceId' not in a]
+    if unattached_eips:
+        released = run_each(lambda alloc: ec2.release_address(AllocationId=alloc), unattached_eips, "release address")
+        lines = [f"Released unused Elastic IPs: {released}"]
+        failed = [alloc for alloc in unattached_eips if alloc not in released]
+        if failed:
+            lines.append(f"⚠️ Could not release unused Elastic IPs: {failed}")
+        return lines, 0
+    return ["No unattached Elastic IPs found."], 0
+
+def section_empty_buckets(s3, buckets):
+    """4. Delete empty S3 buckets"""
+    lines = []
+    buckets = buckets.result()
+    if not buckets:
+        return lines, 0
+    probes = list(ITEM_EXECUTOR.map(lambda bucket: probe_bucket(s3, bucket), buckets))
+
+    for probe in probes:
+        if probe is None:
+            continue
+        name, region, is_empty = probe
+        if is_empty:
+            try:
+                s3_for(region).delete_bucket(Bucket=name)
+                lines.append(f"Deleted empty S3 bucket: {name}")
+            except Exception as e:
+                logger.warning(f"Could not delete bucket {name}: {e}")
+    return lines, 0
+
+def section_ec2_usage(instances):
+    """5. Check EC2 usage (Free Tier 750 hours per month)"""
+    # Count running hours for EC2 micro instances
+    running = [i for i in instances.result() if i['State']['Name'] == 'running']
+    instance_hours = len(running) * 24 * 30
+    if instance_hours > 750:
+        return [f"⚠️ EC2 usage likely exceeds Free Tier (estimated {instance_hours} hours)."], 0
+    return [f"EC2 usage within free-tier limits ({instance_hours} hours est.)."], 0
+
+def total_bucket_size(cloudwatch, buckets, start, end):
+    """Add up the StandardStorage size of each bucket, querying them one by one in batches of 500"""
+    queries = [
+        {
+            'Id': f's{i}',
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'AWS/S3',
+                    'MetricName': 'BucketSizeBytes',
+                    'Dimensions': [
+                        {'Name': 'BucketName', 'Value': bucket['Name']},
+                        {'Name': 'StorageType', 'Value': 'StandardStorage'}
+                    ]
+                },
+                'Period': 86400,
+                'Stat': 'Average'
+            },
+            'ReturnData': True
+        }
+        for i, bucket in enumerate(buckets)
+    ]
+    datapoints = get_metric_datapoints(cloudwatch, queries, start, end)
+    series = [datapoints[q['Id']] for q in queries if datapoints[q['Id']]]
+    if not series:
+        return 0
+    # Buckets report once a day at different times, so total them as of the last complete day
+    as_of = max(points[0][0] for points in series) - datetime.timedelta(days=1)
+    return sum(next((value for ts, value in points if ts <= as_of), points[-1][1]) for points in series)
+
+def section_s3_usage(cloudwatch, buckets, now):
+    """6. Check S3 usage (Free Tier 5 GB)"""
+    start = now - datetime.timedelta(days=30)
+    try:
+        buckets = buckets.result()
+    except Exception as e:
+        # The SEARCH needs no bucket names, so a failed listing only rules out the per-bucket fallback
+        logger.warning(f"Could not list S3 buckets; sizing them with SEARCH only: {e}")
+        buckets = None
+    total_bytes = None
+    if buckets is None or len(buckets) <= SEARCH_MAX_RESULTS:
+        # Let CloudWatch add up every bucket's size server-side in a single query
+        search = ("SEARCH('{AWS/S3,BucketName,StorageType} MetricName=\"BucketSizeBytes\" "
+                  "StorageType=\"StandardStorage\"', 'Average', 86400)")
+        queries = [{'Id': 'total', 'Expression': f'SUM({search})', 'ReturnData': True}]
+        messages = []
+        datapoints = get_metric_datapoints(cloudwatch, queries, start, now, messages)
+        if messages:
+            # SEARCH also matches recently deleted buckets and stops at 500 series, so the sum may be short
+            if buckets is None:
+                raise RuntimeError(f"S3 size SEARCH was incomplete ({messages}) and the bucket listing failed")
+            logger.warning(f"S3 size SEARCH was incomplete ({messages}); querying buckets individually.")
+        else:
+            # Results are newest first; the newest sum may not include buckets that have not reported
+            # for that day yet, so use the day before it
+            points = datapoints['total']
+            total_bytes = points[min(1, len(points) - 1)][1] if points else 0
+    if total_bytes is None:
+        total_bytes = total_bucket_size(cloudwatch, buckets, start, now)
+
+    total_storage_gb = total_bytes / (1024 ** 3)
+    if total_storage_gb > 5:
+        return [f"⚠️ S3 storage exceeds free tier: {total_storage_gb:.2f} GB"], 0
+    return [f"S3 storage within free tier: {total_storage_gb:.2f} GB"], 0
+
+def section_lambda_usage(usage_metrics):
+    """7. Check Lambda usage (Free Tier: 1M requests)"""
+    total_invocations = sum(value for _, value in usage_metrics.result()['lambda_invocations'])
+    if total_invocations > 1_000_000:
+        return [f"⚠️ Lambda usage exceeded free tier: {int(total_invocations)} invocations."], 0
+    return [f"Lambda usage within free tier: {int(total_invocations)} invocations."], 0
+
+def section_rds_usage(rds):
+    """8. Check RDS free-tier usage (750 hours/month)"""
+    rds_instances = list_all(rds, 'describe_db_instances', 'DBInstances[]')
+    active_rds = [r['DBInstanceIdentifier'] for r in rds_instances if r['DBInstanceStatus'] == 'available']
+    rds_hours = len(active_rds) * 24 * 30
+    if rds_hours > 750:
+        return [f"⚠️ RDS usage likely exceeds Free Tier ({rds_hours} hours est.)."], 0
+    return [f"RDS usage within free tier ({rds_hours} hours est.)."], 0
+
+def section_old_snapshots(ec2, cutoff):
+    """9. Delete old EBS snapshots"""
+    # Stream the snapshots page by page; deletes start while later pages are fetched
+    snapshots = iter_all(ec2, 'describe_snapshots', 'Snapshots[]', OwnerIds=['self'])
+    old_snapshots = (
+        snap['SnapshotId'] for snap in snapshots
+        if snap['StartTime'] < cutoff
+    )
+    old_snapshots = run_each(lambda sid: ec2.delete_snapshot(SnapshotId=sid), old_snapshots, "delete snapshot")
+
+    if old_snapshots:
+        return [f"Deleted {len(old_snapshots)} old snapshots (>{SNAPSHOT_RETENTION_DAYS} days)"], len(old_snapshots) * 0.05  # ~$0.05 per GB-month
+    return [], 0
+
+def section_unused_security_groups(ec2, instances):
+    """10. Remove unused security groups"""
+    security_groups = iter_all(ec2, 'describe_security_groups', 'SecurityGroups[]')
+    used_sgs = {
+        sg['GroupId']
+        for i in instances.result() if i['State']['Name'] != 'terminated'
+        for sg in i['SecurityGroups']
+    }
+
+    unused_sgs = (
+        sg['GroupId'] for sg in security_groups
+        if sg['GroupName'] != 'default' and sg['GroupId'] not in used_sgs
+    )
+    unused_sgs = run_each(lambda gid: ec2.delete_security_group(GroupId=gid), unused_sgs, "delete security group")
+
+    if unused_sgs:
+        return [f"Deleted {len(unused_sgs)} unused security groups"], 0
+    return [], 0
+
+def section_unused_load_balancers(elbv2):
+    """11. Delete unused load balancers"""
+    load_balancers = list_all(elbv2, 'describe_load_balancers', 'LoadBalancers[]')
+    if not load_balancers:
+        return [], 0
+    # One listing of all target groups instead of one call per load balancer
+    target_groups = list_all(elbv2, 'describe_target_groups', 'TargetGroups[]')
+    lbs_with_tgs = {arn for tg in target_groups for arn in tg['LoadBalancerArns']}
+    unused_lbs = [lb['LoadBalancerArn'] for lb in load_balancers if lb['LoadBalancerArn'] not in lbs_with_tgs]
+    unused_lbs = run_each(lambda arn: elbv2.delete_load_balancer(LoadBalancerArn=arn), unused_lbs, "delete load balancer")
+
+    if unused_lbs:
+        return [f"Deleted {len(unused_lbs)} unused load balancers"], len(unused_lbs) * 18.25  # ~$18.25/month per ALB
+    return [], 0
+
+def section_log_retention(logs):
+    """12. Set CloudWatch log retention"""
+    log_groups = list_all(logs, 'describe_log_groups', 'logGroups[]')
+    if not log_groups:
+        return [], 0
+    to_update = [
+        lg['logGroupName'] for lg in log_groups
+        if 'retentionInDays' not in lg or lg.get('retentionInDays', 0) > 30
+    ]
+    updated_logs = run_each(
+        lambda name: logs.put_retention_policy(logGroupName=name, retentionInDays=30),
+        to_update,
+        "set retention for"
+    )
+
+    if updated_logs:
+        return [f"Set 30-day retention on {len(updated_logs)} log groups"], 0
+    return [], 0
+
+def section_low_cpu_instances(instances, usage_metrics, now):
+    """13. Identify low-utilization instances"""
+    start = now - datetime.timedelta(days=7)
+    low_cpu_instances = []
+
+    instances.result()  # surface a failed instance listing instead of reporting nothing
+    instance_cpu = usage_metrics.result()['instance_cpu']
+    if not instance_cpu:
+        return [], 0
+
+    # The shared query covers 30 days; only the last week counts here
+    for instance_id, datapoints in instance_cpu.items():
+        recent = [value for timestamp, value in datapoints if timestamp >= start]
+        if recent:
+            avg_cpu = sum(recent) / len(recent)
+            if avg_cpu < LOW_CPU_THRESHOLD:
+                low_cpu_instances.append(f"{instance_id} ({avg_cpu:.1f}% CPU)")
+
+    if low_cpu_instances:
+        return [f"⚠️ Low utilization instances (consider downsizing): {low_cpu_instances}"], 0
+    return [], 0
+
+def section_untagged_volumes(volumes, volume_deletes, cutoff):
+    """14. Delete untagged resources older than threshold"""
+    # Volumes section 2 removed in this run are gone; only flag the ones still left
+    _, deleted = volume_deletes.result()
+    deleted = set(deleted)
+    untagged_volumes = []
+    for vol in volumes.result():
+        if vol['VolumeId'] in deleted:
+            continue
+        if vol['CreateTime'] < cutoff and not vol.get('Tags') and vol['State'] == 'available':
+            untagged_volumes.append(vol['VolumeId'])
+
+    if untagged_volumes:
+        return [f"⚠️ Found {len(untagged_volumes)} untagged volumes older than {CLEANUP_UNTAGGED_AFTER_DAYS} days"], 0
+    return [], 0
+
+def section_cost_analysis(ce, now):
+    """15. Cost analysis"""
+    # Pin the window to the current calendar month so MONTHLY granularity yields a
+    # single period; on the 1st the month is empty (End is exclusive), so use last month
+    end = now.date()
+    start = end.replace(day=1)
+    if start == end:
+        start = (end - datetime.timedelta(days=1)).replace(day=1)
+    request = dict(
+        TimePeriod={
+            'Start': start.strftime('%Y-%m-%d'),
+            'End': end.strftime('%Y-%m-%d')
+        },
+        Granularity='MONTHLY',
+        Metrics=['BlendedCost'],
+        GroupBy=[{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
+    )
+
+    # Cost Explorer has no boto3 paginator, so follow NextPageToken by hand
+    monthly_costs = defaultdict(float)
+    while True:
+        cost_response = ce.get_cost_and_usage(**request)
+        for result in cost_response['ResultsByTime']:
+            for group in result['Groups']:
+                service = group['Keys'][0]
+                cost = float(group['Metrics']['BlendedCost']['Amount'])
+                monthly_costs[service] += cost
+        if not cost_response.get('NextPageToken'):
+            break
+        request['NextPageToken'] = cost_response['NextPageToken']
+
+    top_costs = heapq.nlargest(5, monthly_costs.items(), key=lambda x: x[1])
+    total_monthly = sum(monthly_costs.values())
+    return [
+        f"Top 5 cost drivers: {dict(top_costs)}",
+        f"Total monthly cost: ${total_monthly:.2f}",
+    ], 0
+
+def run_section(section, *clients):
+    """Run one section, containing failures so the other sections still report"""
+    try:
+        return section(*clients)
+    except Exception as e:
+        logger.warning(f"Section {section.__name__} failed: {e}")
+        return [f"⚠️ {section.__doc__} failed: {e}"], 0
+
+def lambda_handler(event, context):
+    logger.info("Starting enhanced AWS cost optimization job...")
+
+    # One clock reading for the whole run; boto3 returns timezone-aware datetimes
+    now = datetime.datetime.now(datetime.timezone.utc)
+    snap_cutoff = now - datetime.timedelta(days=SNAPSHOT_RETENTION_DAYS)
+    untagged_cutoff = now - datetime.timedelta(days=CLEANUP_UNTAGGED_AFTER_DAYS)
+
+    # The sections are independent, so run them concurrently and
+    # collect their results in the original report order
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Shared listings and the metrics batch are submitted before the sections, so a
+        # worker picks each one up before anything waits on it. Sections read them with
+        # .result() inside run_section, so a failed listing only fails its own sections
+        # Sections 1, 5, 10 and 13 all work from the same instance listing
+        all_instances = executor.submit(describe_all_instances, EC2)
+        # Sections 2 and 14 both only look at unattached volumes, so only those are kept
+        available_volumes = executor.submit(list_all, EC2, 'describe_volumes', 'Volumes[]',
+                                            Filters=[{'Name': 'status', 'Values': ['available']}])
+        # Section 2's deletes, which section 14 must not report again
+        volume_deletes = executor.submit(delete_unattached_volumes, EC2, available_volumes)
+        # Sections 4 and 6 both work from the same bucket listing
+        all_buckets = executor.submit(lambda: S3.list_buckets().get('Buckets', []))
+        # Sections 7 and 13 share one GetMetricData batch
+        usage_metrics = executor.submit(fetch_usage_metrics, CLOUDWATCH, all_instances, now)
+        sections = [
+            (section_stopped_ec2, EC2, all_instances),
+            (section_unattached_volumes, volume_deletes),
+            (section_unused_eips, EC2),
+            (section_empty_buckets, S3, all_buckets),
+            (section_ec2_usage, all_instances),
+            (section_s3_usage, CLOUDWATCH, all_buckets, now),
+            (section_lambda_usage, usage_metrics),
+            (section_rds_usage, RDS),
+            (section_old_snapshots, EC2, snap_cutoff),
+            (section_unused_security_groups, EC2, all_instances),
+            (section_unused_load_balancers, ELBV2),
+            (section_log_retention, LOGS),
+            (section_low_cpu_instances, all_instances, usage_metrics, now),
+            (section_untagged_volumes, available_volumes, volume_deletes, untagged_cutoff),
+            (section_cost_analysis, CE, now),
+        ]
+        futures = [executor.submit(run_section, *section) for section in sections]
+        results = [f.result() for f in futures]
+
+    # Build the report in one buffer; the list is kept for the return payload
+    buf = io.StringIO()
+    summary = []
+
+    def emit(line):
+        buf.write(line)
+        buf.write("\n")
+        summary.append(line)
+
+    cost_savings = 0
+    for lines, savings in results:
+        for line in lines:
+            emit(line)
+        cost_savings += savings
+
+    # --- Summary ---
+    emit(f"\n💰 Estimated monthly savings: ${cost_savings:.2f}")
+    report = buf.getvalue()
+    logger.info(report)
+
+    publish_sns(report, "AWS Cost Optimization Report")
+    return {"status": "completed", "summary": summary, "estimated_savings": cost_savings}
@@ -0,0 +1,295 @@
+import datetime
+import os
+import sys
+import unittest
+from concurrent.futures import Future
+from unittest.mock import patch
+
+from botocore.stub import Stubber
+
+# The module builds its clients at import, so give them a region and keep the fan-out serial
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ['MAX_WORKERS'] = '1'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import LamndaCostWatchdog as watchdog
+
+
+def cost_page(costs, next_token=None):
+    page = {
+        'ResultsByTime': [
+            {
+                'Groups': [
+                    {'Keys': [service], 'Metrics': {'BlendedCost': {'Amount': str(amount), 'Unit': 'USD'}}}
+                    for service, amount in costs.items()
+                ]
+            }
+        ]
+    }
+    if next_token:
+        page['NextPageToken'] = next_token
+    return page
+
+def cost_request(start, end, next_token=None):
+    request = {
+        'TimePeriod': {'Start': start, 'End': end},
+        'Granularity': 'MONTHLY',
+        'Metrics': ['BlendedCost'],
+        'GroupBy': [{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
+    }
+    if next_token:
+        request['NextPageToken'] = next_token
+    return request
+
+class TestCostAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.stubber = Stubber(watchdog.CE)
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def test_mid_month_uses_current_month(self):
+        now = datetime.datetime(2024, 3, 15, 8, 0, tzinfo=datetime.timezone.utc)
+        self.stubber.add_response('get_cost_and_usage', cost_page({'EC2': 4}),
+                                  cost_request('2024-03-01', '2024-03-15'))
+
+        lines, savings = watchdog.section_cost_analysis(watchdog.CE, now)
+
+        self.stubber.assert_no_pending_responses()
+        self.assertIn("Total monthly cost: $4.00", lines)
+        self.assertEqual(savings, 0)
+
+    def test_first_of_month_falls_back_to_last_month(self):
+        now = datetime.datetime(2024, 3, 1, 8, 0, tzinfo=datetime.timezone.utc)
+        self.stubber.add_response('get_cost_and_usage', cost_page({'EC2': 4}),
+                                  cost_request('2024-02-01', '2024-03-01'))
+
+        watchdog.section_cost_analysis(watchdog.CE, now)
+
+        self.stubber.assert_no_pending_responses()
+
+    def test_follows_next_page_token(self):
+        now = datetime.datetime(2024, 3, 15, 8, 0, tzinfo=datetime.timezone.utc)
+        self.stubber.add_response('get_cost_and_usage', cost_page({'EC2': 4, 'S3': 1}, 'page-2'),
+                                  cost_request('2024-03-01', '2024-03-15'))
+        self.stubber.add_response('get_cost_and_usage', cost_page({'EC2': 2, 'RDS': 3}),
+                                  cost_request('2024-03-01', '2024-03-15', 'page-2'))
+
+        lines, _ = watchdog.section_cost_analysis(watchdog.CE, now)
+
+        self.stubber.assert_no_pending_responses()
+        self.assertIn("Top 5 cost drivers: {'EC2': 6.0, 'RDS': 3.0, 'S3': 1.0}", lines)
+        self.assertIn("Total monthly cost: $10.00", lines)
+
+class TestOversizedReport(unittest.TestCase):
+
+    def test_truncation_keeps_valid_utf8_under_the_limit(self):
+        # Put a 4-byte character across the cut so a plain byte slice would split it
+        message = 'x' * (watchdog.SNS_MAX_MESSAGE_BYTES - 60) + '💰' * 100
+
+        truncated = watchdog.truncate_report(message)
+
+        note = "\n\n[Report truncated; see CloudWatch Logs for the full text]"
+        encoded = truncated.encode('utf-8')
+        self.assertLessEqual(len(encoded), watchdog.SNS_MAX_MESSAGE_BYTES)
+        self.assertEqual(encoded.decode('utf-8'), truncated)
+        self.assertTrue(truncated.endswith(note))
+        self.assertTrue(message.startswith(truncated[:-len(note)]))
+
+    def test_failed_upload_falls_back_to_truncation(self):
+        message = 'x' * (watchdog.SNS_MAX_MESSAGE_BYTES + 1)
+        # HeadBucket gives no region, so the upload goes through the client for the default region
+        head_stubber = Stubber(watchdog.S3)
+        head_stubber.add_client_error('head_bucket', 'AccessDenied', http_status_code=403)
+        upload_stubber = Stubber(watchdog.s3_for('us-east-1'))
+        upload_stubber.add_client_error('put_object', 'AccessDenied', http_status_code=403)
+        original_bucket = watchdog.REPORT_BUCKET
+        watchdog.REPORT_BUCKET = 'report-bucket'
+        try:
+            with head_stubber, upload_stubber, self.assertLogs(watchdog.logger, 'WARNING') as logs:
+                result = watchdog.oversized_report_message(message)
+            upload_stubber.assert_no_pending_responses()
+        finally:
+            watchdog.REPORT_BUCKET = original_bucket
+
+        self.assertIn('Could not upload report to report-bucket', logs.output[-1])
+        self.assertEqual(result, watchdog.truncate_report(message))
+
+def done(result=None, error=None):
+    future = Future()
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+def metric_result(query_id, points, messages=None):
+    result = {
+        'Id': query_id,
+        'Timestamps': [ts for ts, _ in points],
+        'Values': [value for _, value in points],
+        'StatusCode': 'Complete'
+    }
+    if messages:
+        result['Messages'] = messages
+    return result
+
+class TestS3Usage(unittest.TestCase):
+
+    NOW = datetime.datetime(2024, 3, 15, 8, 0, tzinfo=datetime.timezone.utc)
+    DAY = datetime.timedelta(days=1)
+    GB = 1024 ** 3
+
+    def setUp(self):
+        self.stubber = Stubber(watchdog.CLOUDWATCH)
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def usage(self, buckets):
+        lines, _ = watchdog.section_s3_usage(watchdog.CLOUDWATCH, buckets, self.NOW)
+        self.stubber.assert_no_pending_responses()
+        return lines
+
+    def search_response(self, points, messages=None):
+        self.stubber.add_response('get_metric_data', {'MetricDataResults': [metric_result('total', points, messages)]})
+
+    def test_search_without_datapoints(self):
+        self.search_response([])
+        self.assertEqual(self.usage(done([{'Name': 'b1'}])), ["S3 storage within free tier: 0.00 GB"])
+
+    def test_search_with_one_datapoint(self):
+        self.search_response([(self.NOW, 2 * self.GB)])
+        self.assertEqual(self.usage(done([{'Name': 'b1'}])), ["S3 storage within free tier: 2.00 GB"])
+
+    def test_search_skips_the_newest_possibly_partial_day(self):
+        self.search_response([(self.NOW, 2 * self.GB), (self.NOW - self.DAY, 6 * self.GB), (self.NOW - 2 * self.DAY, 1 * self.GB)])
+        self.assertEqual(self.usage(done([{'Name': 'b1'}])), ["⚠️ S3 storage exceeds free tier: 6.00 GB"])
+
+    def test_search_messages_fall_back_to_per_bucket_queries(self):
+        self.search_response([(self.NOW, 1 * self.GB)], [{'Code': 'MaxQueryResults', 'Value': 'Too many results'}])
+        self.stubber.add_response('get_metric_data', {'MetricDataResults': [
+            metric_result('s0', [(self.NOW, 4 * self.GB), (self.NOW - self.DAY, 3 * self.GB)]),
+            metric_result('s1', [(self.NOW - self.DAY, 3 * self.GB)])
+        ]})
+
+        with self.assertLogs(watchdog.logger, 'WARNING'):
+            lines = self.usage(done([{'Name': 'b1'}, {'Name': 'b2'}]))
+
+        self.assertEqual(lines, ["⚠️ S3 storage exceeds free tier: 6.00 GB"])
+
+    def test_failed_bucket_listing_still_uses_search(self):
+        self.search_response([(self.NOW, 2 * self.GB), (self.NOW - self.DAY, 3 * self.GB)])
+        with self.assertLogs(watchdog.logger, 'WARNING'):
+            lines = self.usage(done(error=RuntimeError('AccessDenied')))
+        self.assertEqual(lines, ["S3 storage within free tier: 3.00 GB"])
+
+    def test_total_bucket_size_as_of_the_last_complete_day(self):
+        # b1 reported today and yesterday, b2 only yesterday, b3 only today, b4 three days ago
+        self.stubber.add_response('get_metric_data', {'MetricDataResults': [
+            metric_result('s0', [(self.NOW, 100.0), (self.NOW - self.DAY, 90.0)]),
+            metric_result('s1', [(self.NOW - self.DAY, 20.0)]),
+            metric_result('s2', [(self.NOW, 30.0)]),
+            metric_result('s3', [(self.NOW - 3 * self.DAY, 7.0)]),
+            metric_result('s4', [])
+        ]})
+        buckets = [{'Name': f'b{i}'} for i in range(1, 6)]
+
+        total = watchdog.total_bucket_size(watchdog.CLOUDWATCH, buckets, self.NOW - 30 * self.DAY, self.NOW)
+
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(total, 147.0)
+
+class TestReleaseReporting(unittest.TestCase):
+
+    def test_unreleased_elastic_ips_are_named(self):
+        stubber = Stubber(watchdog.EC2)
+        stubber.add_response('describe_addresses', {'Addresses': [
+            {'AllocationId': 'eipalloc-1'},
+            {'AllocationId': 'eipalloc-2'},
+            {'AllocationId': 'eipalloc-3', 'InstanceId': 'i-1'}
+        ]})
+        stubber.add_response('release_address', {}, {'AllocationId': 'eipalloc-1'})
+        stubber.add_client_error('release_address', 'InvalidAddress.Locked', expected_params={'AllocationId': 'eipalloc-2'})
+
+        with stubber, self.assertLogs(watchdog.logger, 'WARNING'):
+            lines, _ = watchdog.section_unused_eips(watchdog.EC2)
+
+        self.assertEqual(lines, [
+            "Released unused Elastic IPs: ['eipalloc-1']",
+            "⚠️ Could not release unused Elastic IPs: ['eipalloc-2']"
+        ])
+
+    def test_undeleted_volumes_are_named(self):
+        lines, _ = watchdog.section_unattached_volumes(done((['vol-1', 'vol-2'], [])))
+
+        self.assertEqual(lines, [
+            "Deleted unused EBS volumes: []",
+            "⚠️ Could not delete unused EBS volumes: ['vol-1', 'vol-2']"
+        ])
+
+class TestRetryLogging(unittest.TestCase):
+
+    def test_failed_call_is_not_logged_as_succeeded(self):
+        stubber = Stubber(watchdog.SNS)
+        stubber.add_client_error('publish', 'Throttling', http_status_code=400, response_meta={'RetryAttempts': 9})
+        with stubber, self.assertLogs(watchdog.logger, 'WARNING') as logs:
+            with self.assertRaises(watchdog.ClientError):
+                watchdog.SNS.publish(TopicArn=watchdog.SNS_TOPIC_ARN, Message='report')
+
+        self.assertEqual(logs.output, ['WARNING:root:sns Publish failed after 9 retries'])
+
+class TestRunEach(unittest.TestCase):
+
+    def test_generator_input_with_partial_failures(self):
+        def delete(item):
+            if item % 2:
+                raise RuntimeError('DependencyViolation')
+
+        items = (i for i in range(6))
+        with self.assertLogs(watchdog.logger, 'WARNING') as logs:
+            done = watchdog.run_each(delete, items, 'delete item')
+
+        self.assertEqual(done, [0, 2, 4])
+        self.assertEqual(len(logs.records), 3)
+        self.assertIn('Could not delete item 1: DependencyViolation', logs.output[0])
+
+    def test_listing_failure_still_reports_submitted_calls(self):
+        deleted = []
+
+        def items():
+            yield 'snap-1'
+            yield 'snap-2'
+            raise RuntimeError('Throttling')
+
+        with self.assertRaises(RuntimeError) as raised:
+            watchdog.run_each(deleted.append, items(), 'delete snapshot')
+
+        self.assertEqual(deleted, ['snap-1', 'snap-2'])
+        self.assertIn('Throttling', str(raised.exception))
+        self.assertIn("delete snapshot: ['snap-1', 'snap-2']", str(raised.exception))
+
+    def test_section_reports_deletes_next_to_listing_error(self):
+        old = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        cutoff = datetime.datetime(2024, 3, 1, tzinfo=datetime.timezone.utc)
+
+        def snapshots(*args, **kwargs):
+            yield {'SnapshotId': 'snap-1', 'StartTime': old}
+            raise RuntimeError('RequestLimitExceeded')
+
+        stubber = Stubber(watchdog.EC2)
+        stubber.add_response('delete_snapshot', {}, {'SnapshotId': 'snap-1'})
+        with stubber, patch.object(watchdog, 'iter_all', snapshots), self.assertLogs(watchdog.logger, 'WARNING'):
+            lines, _ = watchdog.run_section(watchdog.section_old_snapshots, watchdog.EC2, cutoff)
+
+        stubber.assert_no_pending_responses()
+        self.assertTrue(lines[0].startswith('⚠️ 9. Delete old EBS snapshots failed: RequestLimitExceeded'))
+        self.assertIn("delete snapshot: ['snap-1']", lines[0])
+
+if __name__ == '__main__':
+    unittest.main()